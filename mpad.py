@@ -1,17 +1,19 @@
-import os
+import socket
 import subprocess
 import time
-import digitalio
 import board
-import adafruit_matrixkeypad
+import keypad
+import alsaaudio
 
-cols = [digitalio.DigitalInOut(x) for x in (board.D5, board.D6, board.D12)]
-rows = [digitalio.DigitalInOut(x) for x in (board.D27, board.D22, board.D23, board.D24)]
-keys = ((1,2,3),(4,5,6),(7,8,9),('vup',0,'vdown'))
+cols = (board.D5, board.D6, board.D12)
+rows = (board.D27, board.D22, board.D23, board.D24)
+keys = (1,2,3,4,5,6,7,8,9,'vup',0,'vdown')
 
-keypad = adafruit_matrixkeypad.Matrix_Keypad(rows, cols, keys)
+# keypad scans and debounces the matrix in its own thread and queues press/release
+# events, so keypresses are not lost while a previous one is being handled
+matrix = keypad.KeyMatrix(rows, cols, interval=0.02)
 
-check_keypad = True
+mixer = alsaaudio.Mixer('PCM')
 
 def SiriusActiveQ():
   '''
@@ -21,50 +23,112 @@ def SiriusActiveQ():
   r = subprocess.call(['systemctl','is-active','siriusxm'])
   return (r == 0)
 
+VLC_HOST = ('127.0.0.1', 4212)
+vlc = None
+vlc_sock = None
+
+def startVLC():
+  '''
+  Launches a single cvlc that is kept running and controlled over its rc interface
+  '''
+  global vlc
+  if vlc is None or vlc.poll() is not None:
+    vlc = subprocess.Popen(['cvlc', '--extraintf', 'rc', '--rc-host', '{}:{}'.format(*VLC_HOST), '--no-video'],
+      stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def connectVLC(attempts=50):
+  '''
+  Opens the rc socket, starting vlc if necessary.  vlc takes a moment to start listening.
+  '''
+  global vlc_sock
+  startVLC()
+  for _ in range(attempts):
+    try:
+      vlc_sock = socket.create_connection(VLC_HOST)
+      vlc_sock.setblocking(False)
+      return True
+    except OSError:
+      time.sleep(0.1)
+  vlc_sock = None
+  return False
+
+def sendVLC(*commands):
+  '''
+  Sends rc commands to vlc, reconnecting once if the socket has gone away
+  '''
+  global vlc_sock
+  data = ''.join('{}\n'.format(c) for c in commands).encode()
+  for _ in range(2):
+    if vlc_sock is None and not connectVLC():
+      return False
+    try:
+      # discard rc output so vlc never blocks writing to us; an empty read means
+      # vlc closed the connection, so reconnect before sending
+      while True:
+        if not vlc_sock.recv(4096):
+          raise ConnectionResetError('vlc closed the rc connection')
+    except BlockingIOError:
+      pass
+    except OSError:
+      vlc_sock.close()
+      vlc_sock = None
+      continue
+    try:
+      vlc_sock.setblocking(True)
+      vlc_sock.sendall(data)
+      vlc_sock.setblocking(False)
+      return True
+    except OSError:
+      vlc_sock.close()
+      vlc_sock = None
+  return False
+
 def killVLC():
   '''
-  Ensures that vlc is not running
+  Stops whatever vlc is playing
+  '''
+  sendVLC('clear')
+
+def playVLC(source, shuffle=False):
+  '''
+  Replaces the vlc playlist with source and starts playing it
   '''
-  os.system('killall vlc')
+  mode = 'on' if shuffle else 'off'
+  sendVLC('clear', 'random {}'.format(mode), 'loop {}'.format(mode), 'add {}'.format(source))
 
 def SiriusPlay(channel):
   ''' 
   Plays a channel, does not check if channel is valid
   '''
-  killVLC()
-  subprocess.Popen(['cvlc','http://127.0.0.1:8888/{}.m3u8'.format(channel)])
+  playVLC('http://127.0.0.1:8888/{}.m3u8'.format(channel))
 
 def playClassical():
   '''
   Plays theclassicalstation.org
   '''
-  killVLC()
-  subprocess.Popen(['cvlc', 'http://audio-ogg.ibiblio.org:8000/wcpe.ogg.m3u'])
+  playVLC('http://audio-ogg.ibiblio.org:8000/wcpe.ogg.m3u')
 
 def playLocal():
   '''
   Plays random songs in the Music directory
   '''
-  killVLC()
-  subprocess.Popen(['cvlc', '-Z', '/mnt/bespin/Shared Music/Rozenn'])
+  playVLC('/mnt/bespin/Shared Music/Rozenn', shuffle=True)
 
 def playHalloween():
   '''
   Plays random songs in the Halloween directory
   '''
-  killVLC()
-  subprocess.Popen(['cvlc', '-Z', '/mnt/bespin/Shared Music/Halloween'])
+  playVLC('/mnt/bespin/Shared Music/Halloween', shuffle=True)
 
 def speak(statement):
-  os.system('espeak -w /tmp/out.wav -ven+f3 -k5 -s150 -a125 "{}" 2>/dev/null'.format(statement))
-  os.system('aplay /temp/out.wav')
-  #subprocess.call(['espeak','-s','125','-a','150',str(statement)])
+  # espeak plays directly, no shell and no wav roundtrip through aplay
+  subprocess.run(['espeak', '-ven+f3', '-k5', '-s150', '-a125', str(statement)], stderr=subprocess.DEVNULL)
 
 def constrain(val, min_val, max_val):
   return min(max_val, max(min_val, val))
 def setvolume(volume):
   vol = constrain(volume,0,100) # Just making sure
-  subprocess.run(['amixer', 'sset','PCM','{}%'.format(vol)])
+  mixer.setvolume(vol)
 
 def process_keypress(key):
   global volume
@@ -98,6 +162,9 @@ def process_keypress(key):
   else:
     speak('I do not understand.')
 
+print("Starting vlc")
+connectVLC()
+
 print("Setting default volume to 75%")
 volume = 75
 setvolume(volume)
@@ -105,13 +172,16 @@ setvolume(volume)
 print("Do something")
 while True:
   try:
-    if check_keypad:
-      keys = keypad.pressed_keys
-      if keys:
-        check_keypad = False
-        process_keypress(keys[0])
-        check_keypad = True
+    event = matrix.events.get()
+    if event is None:
+      # the keypad thread keeps debouncing and queueing while we sleep, so no presses are lost
       time.sleep(0.1)
+    elif event.pressed:
+      process_keypress(keys[event.key_number])
   except (KeyboardInterrupt, EOFError, SystemExit):
     break
 
+matrix.deinit()
+if vlc is not None:
+  vlc.terminate()
+
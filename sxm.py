@@ -22,11 +22,10 @@ Authentication:
 
 Dependencies:
     - requests
-    - base64
     - urllib.parse
     - json
+    - ujson (optional, faster decoding of API responses)
     - time
-    - datetime
     - sys
     - http.server
     - logging
@@ -34,15 +33,27 @@ Dependencies:
 
 """
 import argparse
+import collections
+import concurrent.futures
+import queue
+import re
+import threading
 import requests
-import base64
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import urllib.parse
 import json
-import time, datetime
+try:
+    import ujson as fastjson
+except ImportError:
+    fastjson = json
+import time
 import sys
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 from my_secrets import secrets
 import logging
+from operator import itemgetter
 import Adafruit_IO
 
 
@@ -53,6 +64,79 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 aio = Adafruit_IO.Client(secrets['aio_user'], secrets['aio_key'])
 now_playing_feed = aio.feeds('now-playing') # Assumes the feed exists
 
+_VARIANT_RE = re.compile(r'^([^#\s].*\.m3u8)[ \t\r]*$', re.M)
+_SEGMENT_RE = re.compile(r'^([^#\s].*\.aac)[ \t\r]*$', re.M)
+_TARGET_DURATION_RE = re.compile(r'^#EXT-X-TARGETDURATION:(\d+)', re.M)
+
+# Request bodies for login and session authentication never change apart from the
+# credentials, so they are serialized once here
+_DEVICE_INFO = {
+    'osVersion': 'Mac',
+    'platform': 'Web',
+    'clientDeviceType': 'web',
+    'sxmAppVersion': '3.1802.10011.0',
+    'browser': 'Safari',
+    'browserVersion': '11.0.3',
+    'appRegion': 'US',
+    'deviceModel': 'K2WebClient',
+    'player': 'html5',
+    'clientDeviceId': 'null'
+}
+_LOGIN_POSTDATA = fastjson.dumps({
+    'moduleList': {
+        'modules': [{
+            'moduleRequest': {
+                'resultTemplate': 'web',
+                'deviceInfo': _DEVICE_INFO,
+                'standardAuth': {
+                    'username': '__USERNAME__',
+                    'password': '__PASSWORD__',
+                },
+            },
+        }],
+    },
+})
+_AUTH_POSTDATA = fastjson.dumps({
+    'moduleList': {
+        'modules': [{
+            'moduleRequest': {
+                'resultTemplate': 'web',
+                'deviceInfo': _DEVICE_INFO
+            }
+        }]
+    }
+})
+
+# AES decryption key for HLS segments (base64 0Nsco7MAgxowGvkUT8aYag==)
+HLS_AES_KEY = b'\xd0\xdb\x1c\xa3\xb3\x00\x83\x1a0\x1a\xf9\x14O\xc6\x98j'
+
+# Background segment fetches share a small pool; a player only needs the few newest
+# segments warmed, and the fetches reuse the session's pooled connections
+_PREFETCH_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+class NowPlaying(collections.namedtuple('NowPlaying', 'live markers cut')):
+    @property
+    def station(self):
+        # looked up on demand since not every caller needs it, and it may be missing
+        return self.markers[0]['markers'][0]['episode']['longTitle']
+
+def _now_playing(data):
+    """
+    Walks a tune/now-playing-live response once and returns the parts we use.
+    Raises KeyError or IndexError if the response is missing them.
+    """
+    live = data['ModuleListResponse']['moduleList']['modules'][0]['moduleResponse']['liveChannelData']
+    markers = live['markerLists']
+    return NowPlaying(
+        live=live,
+        markers=markers,
+        cut=markers[3]['markers'][-1]['cut'],
+    )
+
+def _loads(res):
+    # decode the raw bytes ourselves; res.json() goes through res.text and stdlib json
+    return fastjson.loads(res.content.decode('utf-8'))
+
 class SiriusXM:
     """
     Handles SiriusXM authentication and stream retrieval.
@@ -61,6 +145,9 @@ class SiriusXM:
         USER_AGENT (str): User-Agent string for HTTP requests.
         REST_FORMAT (str): Base URL for SiriusXM REST API.
         LIVE_PRIMARY_HLS (str): Base URL for HLS streams.
+        SEGMENT_CACHE_SIZE (int): Number of segments kept in the in-memory cache.
+        PREFETCH_SEGMENTS (int): Number of live-edge segments prefetched per playlist, one per prefetch worker.
+        MANIFEST_TTL (int): Default lifetime in seconds of a cached playlist.
 
     Methods:
         log(message, level): Logs messages with specified level.
@@ -72,24 +159,46 @@ class SiriusXM:
         authenticate(): Authenticates the session.
         get_sxmak_token(): Retrieves the SXMAKTOKEN from cookies.
         get_gup_id(): Retrieves the gupId from cookies.
+        get_token_params(): Returns the cached token/gupId query parameters for HLS requests.
         get_playlist_url(guid, channel_id, use_cache, max_attempts): Retrieves the playlist URL for a channel.
         get_playlist_variant_url(url): Retrieves the playlist variant URL.
         get_playlist(name, use_cache): Retrieves the HLS playlist for a channel.
-        get_segment(path, max_attempts): Retrieves a segment of the audio stream.
+        get_segment(path, max_attempts): Retrieves a segment of the audio stream, from the cache if possible.
+        prefetch_segments(paths): Fetches segments into the cache on the module's shared prefetch pool.
         get_channels(): Retrieves the list of available channels.
         get_channel(name): Retrieves channel information by name or ID.
     """
     USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/604.5.6 (KHTML, like Gecko) Version/11.0.3 Safari/604.5.6'
     REST_FORMAT = 'https://player.siriusxm.com/rest/v2/experience/modules/{}'
     LIVE_PRIMARY_HLS = 'https://siriusxm-priprodlive.akamaized.net'
+    SEGMENT_CACHE_SIZE = 24 # roughly 3-4 minutes of audio
+    PREFETCH_SEGMENTS = 2
+    MANIFEST_TTL = 5 # used when a playlist has no #EXT-X-TARGETDURATION
 
     def __init__(self, username, password):
         self.session = requests.Session()
         self.session.headers.update({'User-Agent': self.USER_AGENT})
+        # keep connections to the API and the HLS origin warm across segment fetches
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32,
+                              max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+                                                raise_on_status=False))
+        self.session.mount(self.LIVE_PRIMARY_HLS, adapter)
+        self.session.mount('https://player.siriusxm.com', adapter)
         self.username = username
         self.password = password
         self.playlists = {}
+        self._playlist_lock = threading.Lock()
         self.channels = None
+        self._channel_index = {}
+        self._token_params = None
+        self._token_lock = threading.Lock()
+        self._segment_cache = collections.OrderedDict()
+        self._segment_lock = threading.Lock()
+        self._prefetching = {}
+        self._manifest_cache = {}
+        self._aio_queue = queue.Queue(maxsize=32)
+        self._aio_last_sent = None
+        threading.Thread(target=self._aio_worker, daemon=True).start()
 
     # Wrapper for logging may not be needed
     def log(self, message, level="DEBUG"):
@@ -100,6 +209,20 @@ class SiriusXM:
         elif level == "ERROR":
             logging.error(message)
 
+    def _aio_worker(self):
+        while True:
+            payload = self._aio_queue.get()
+            # unchanged now playing info does not need to be sent again
+            if payload == self._aio_last_sent:
+                continue
+            try:
+                aio.send_data(now_playing_feed.key, payload)
+                self._aio_last_sent = payload
+                logging.debug('Data successfully sent to Adafruit')
+            except Exception as e:
+                # keep the worker alive through throttling, network errors and the like
+                logging.error("Error updating Adafruit-IO: {}".format(e))
+
     def is_logged_in(self):
         return 'SXMAUTHNEW' in self.session.cookies
 
@@ -117,7 +240,7 @@ class SiriusXM:
             return None
 
         try:
-            return res.json()
+            return _loads(res)
         except ValueError:
             self.log('Error decoding json for method \'{}\''.format(method))
             return None
@@ -126,45 +249,24 @@ class SiriusXM:
         if authenticate and not self.is_session_authenticated() and not self.authenticate():
             self.log('Unable to authenticate')
             return None
-        req = 'wassup'
-        print(self.REST_FORMAT.format(method))
-        res = self.session.post(self.REST_FORMAT.format(method), data=json.dumps(postdata))
+        self.log('POST {}'.format(method), 'DEBUG')
+        if not isinstance(postdata, str):
+            postdata = fastjson.dumps(postdata)
+        res = self.session.post(self.REST_FORMAT.format(method), data=postdata)
         if res.status_code != 200:
             self.log('Received status code {} for method \'{}\''.format(res.status_code, method))
             return None
 
         try:
-            return res.json()
+            return _loads(res)
         except ValueError:
             self.log('Error decoding json for method \'{}\''.format(method))
             return None
 
     def login(self):
-        postdata = {
-            'moduleList': {
-                'modules': [{
-                    'moduleRequest': {
-                        'resultTemplate': 'web',
-                        'deviceInfo': {
-                            'osVersion': 'Mac',
-                            'platform': 'Web',
-                            'sxmAppVersion': '3.1802.10011.0',
-                            'browser': 'Safari',
-                            'browserVersion': '11.0.3',
-                            'appRegion': 'US',
-                            'deviceModel': 'K2WebClient',
-                            'clientDeviceId': 'null',
-                            'player': 'html5',
-                            'clientDeviceType': 'web',
-                        },
-                        'standardAuth': {
-                            'username': self.username,
-                            'password': self.password,
-                        },
-                    },
-                }],
-            },
-        }
+        # credentials are json encoded into the pre-serialized request body
+        postdata = _LOGIN_POSTDATA.replace('"__USERNAME__"', fastjson.dumps(self.username)) \
+                                  .replace('"__PASSWORD__"', fastjson.dumps(self.password))
         data = self.post('modify/authentication', postdata, authenticate=False)
         if not data:
             return False
@@ -176,40 +278,27 @@ class SiriusXM:
             return False
 
     def authenticate(self):
-        if not self.is_logged_in() and not self.login():
-            self.log('Unable to authenticate because login failed')
-            return False
+        try:
+            if not self.is_logged_in() and not self.login():
+                self.log('Unable to authenticate because login failed')
+                return False
 
-        postdata = {
-            'moduleList': {
-                'modules': [{
-                    'moduleRequest': {
-                        'resultTemplate': 'web',
-                        'deviceInfo': {
-                            'osVersion': 'Mac',
-                            'platform': 'Web',
-                            'clientDeviceType': 'web',
-                            'sxmAppVersion': '3.1802.10011.0',
-                            'browser': 'Safari',
-                            'browserVersion': '11.0.3',
-                            'appRegion': 'US',
-                            'deviceModel': 'K2WebClient',
-                            'player': 'html5',
-                            'clientDeviceId': 'null'
-                        }
-                    }
-                }]
-            }
-        }
-        data = self.post('resume?OAtrial=false', postdata, authenticate=False)
-        if not data:
-            return False
+            data = self.post('resume?OAtrial=false', _AUTH_POSTDATA, authenticate=False)
+            if not data:
+                return False
 
-        try:
-            return data['ModuleListResponse']['status'] == 1 and self.is_session_authenticated()
-        except KeyError:
-            self.log('Error parsing json response for authentication')
-            return False
+            try:
+                return data['ModuleListResponse']['status'] == 1 and self.is_session_authenticated()
+            except KeyError:
+                self.log('Error parsing json response for authentication')
+                return False
+        finally:
+            # the token cookies may have been replaced
+            self._clear_token_cache()
+
+    def _clear_token_cache(self):
+        with self._token_lock:
+            self._token_params = None
 
     def get_sxmak_token(self):
         try:
@@ -219,101 +308,133 @@ class SiriusXM:
 
     def get_gup_id(self):
         try:
-            return json.loads(urllib.parse.unquote(self.session.cookies['SXMDATA']))['gupId']
+            return fastjson.loads(urllib.parse.unquote(self.session.cookies['SXMDATA']))['gupId']
         except (KeyError, ValueError):
             return None
 
-    def get_playlist_info(self, guid, channel_id, use_cache=False, max_attempts=5):
-
-        params = {
+    def get_token_params(self):
+        # token and gupId come from cookies that only change when the session is renewed,
+        # so they are parsed once and cached until authenticate() or a 403 clears them
+        params = self._token_params
+        if params is None:
+            with self._token_lock:
+                if self._token_params is None:
+                    params = {
+                        'token': self.get_sxmak_token(),
+                        'consumer': 'k2',
+                        'gupId': self.get_gup_id(),
+                    }
+                    if params['token'] is None or params['gupId'] is None:
+                        return params
+                    self._token_params = params
+                params = self._token_params
+        return params
+
+    def _now_params(self, guid, channel_id):
+        ms = int(time.time() * 1000)
+        return {
             'assetGUID': guid,
             'ccRequestType': 'AUDIO_VIDEO',
             'channelId': channel_id,
             'hls_output_mode': 'custom',
             'marker_mode': 'all_separate_cue_points',
             'result-template': 'web',
-            'time': int(round(time.time() * 1000.0)),
-            'timestamp': datetime.datetime.utcnow().isoformat('T') + 'Z'
+            'time': ms,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(ms // 1000)) + '.{:03d}Z'.format(ms % 1000)
         }
-        data = self.get('tune/now-playing-live', params)
-        if not data:
-            return None
 
-        # get status
-        try:
-            status = data['ModuleListResponse']['status']
-            message = data['ModuleListResponse']['messages'][0]['message']
-            message_code = data['ModuleListResponse']['messages'][0]['code']
-        except (KeyError, IndexError):
-            self.log('Error parsing json response for playlist')
-            return None
+    def _fetch_now_playing(self, guid, channel_id, max_attempts=5):
+        params = self._now_params(guid, channel_id)
+        for attempt in range(max_attempts + 1):
+            data = self.get('tune/now-playing-live', params)
+            if not data:
+                return None
 
-        # login if session expired
-        if message_code == 201 or message_code == 208:
-            if max_attempts > 0:
+            # get status
+            try:
+                status = data['ModuleListResponse']['status']
+                message = data['ModuleListResponse']['messages'][0]['message']
+                message_code = data['ModuleListResponse']['messages'][0]['code']
+            except (KeyError, IndexError):
+                self.log('Error parsing json response for playlist')
+                return None
+
+            # login if session expired
+            if message_code == 201 or message_code == 208:
+                if attempt == max_attempts:
+                    self.log('Reached max attempts for playlist')
+                    return None
                 self.log('Session expired, logging in and authenticating')
-                if self.authenticate():
-                    self.log('Successfully authenticated')
-                else:
+                if not self.authenticate():
                     self.log('Failed to authenticate')
                     return None
-            else:
-                self.log('Reached max attempts for playlist')
+                self.log('Successfully authenticated')
+                continue
+            elif message_code != 100:
+                self.log('Received error {} {}'.format(message_code, message))
                 return None
-        elif message_code != 100:
-            self.log('Received error {} {}'.format(message_code, message))
-            return None
+            break
 
         # get m3u8 url
         try:
             playlists = data['ModuleListResponse']['moduleList']['modules'][0]['moduleResponse']['liveChannelData']['hlsAudioInfos']
-            mydata = data['ModuleListResponse']['moduleList']['modules'][0]['moduleResponse']['liveChannelData']
-            self.log(mydata['markerLists'][3]['markers'][-1]['cut']['title'])
         except (KeyError, IndexError):
             self.log('Error parsing json response for playlist')
             return None
         for playlist_info in playlists:
             if playlist_info['size'] == 'LARGE':
                 playlist_url = playlist_info['url'].replace('%Live_Primary_HLS%', self.LIVE_PRIMARY_HLS)
-                self.playlists[channel_id] = self.get_playlist_variant_url(playlist_url)
-                return data['ModuleListResponse']['moduleList']['modules'][0]['moduleResponse']['liveChannelData']
+                variant_url = self.get_playlist_variant_url(playlist_url)
+                with self._playlist_lock:
+                    self.playlists[channel_id] = variant_url
+                return data
 
         return None
 
-    def get_song_info(self, guid, channel_id, full_data=False):
-        params = {
-            'assetGUID': guid,
-            'ccRequestType': 'AUDIO_VIDEO',
-            'channelId': channel_id,
-            'hls_output_mode': 'custom',
-            'marker_mode': 'all_separate_cue_points',
-            'result-template': 'web',
-            'time': int(round(time.time() * 1000.0)),
-            'timestamp': datetime.datetime.utcnow().isoformat('T') + 'Z'
-        }
-        data = self.get('tune/now-playing-live', params)
+    def get_playlist_info(self, guid, channel_id, use_cache=False, max_attempts=5):
+        data = self._fetch_now_playing(guid, channel_id, max_attempts)
+        if not data:
+            return None
+
+        try:
+            now_playing = _now_playing(data)
+        except (KeyError, IndexError):
+            self.log('Error parsing json response for playlist')
+            return None
+        self.log(now_playing.cut['title'])
+        return now_playing.live
+
+    def get_song_info(self, guid, channel_id, full_data=False, data=None):
+        # data may be passed in by a caller that already fetched now-playing-live
+        if data is None:
+            data = self.get('tune/now-playing-live', self._now_params(guid, channel_id))
         if not data:
             return None
 
         # get song info
-        musicdata = data['ModuleListResponse']['moduleList']['modules'][0]['moduleResponse']['liveChannelData']
-        station = musicdata['markerLists'][0]['markers'][0]['episode']['longTitle']
+        try:
+            now_playing = _now_playing(data)
+            title = now_playing.cut['title']
+            artist = now_playing.cut['artists'][0]['name']
+            station = now_playing.station
+        except (KeyError, IndexError):
+            self.log('Error parsing json response for song info')
+            return None
         logging.info("STATION: {}".format(station))
-        logging.info("SONG: {}".format(musicdata['markerLists'][3]['markers'][-1]['cut']['title']))
-        logging.info("ARTIST: {}".format(musicdata['markerLists'][3]['markers'][-1]['cut']['artists'][0]['name']))
-
-        # post to Adafruit_IO
+        logging.info("SONG: {}".format(title))
+        logging.info("ARTIST: {}".format(artist))
+
+        # post to Adafruit_IO in the background so the playlist is not held up
+        data_to_send = {
+            'title': title,
+            'artist': artist,
+            'station': station,
+            'playing': True,
+        }
         try:
-            data_to_send = {
-                'title': musicdata['markerLists'][3]['markers'][-1]['cut']['title'],
-                'artist': musicdata['markerLists'][3]['markers'][-1]['cut']['artists'][0]['name'],
-                'station': station,
-                'playing': True,
-            }
-            aio.send_data(now_playing_feed.key, json.dumps(data_to_send))
-            logging.debug('Data successfully sent to Adafruit')
-        except Adafruit_IO.RequestError as e:
-            logging.error("Error updating Adafruit-IO: {}".format(e))
+            self._aio_queue.put_nowait(fastjson.dumps(data_to_send, sort_keys=True))
+        except queue.Full:
+            logging.debug('Adafruit-IO queue full, dropping update')
 
         if full_data:
             return data
@@ -321,88 +442,39 @@ class SiriusXM:
             return None        
 
     def get_playlist_url(self, guid, channel_id, use_cache=True, max_attempts=5):
-        # Get song info - this adds a SiriusXM call
-        self.get_song_info(guid, channel_id)
-
         if use_cache and channel_id in self.playlists:
-             return self.playlists[channel_id]
+            # Get song info - this adds a SiriusXM call
+            self.get_song_info(guid, channel_id)
+            return self.playlists[channel_id]
 
-        params = {
-            'assetGUID': guid,
-            'ccRequestType': 'AUDIO_VIDEO',
-            'channelId': channel_id,
-            'hls_output_mode': 'custom',
-            'marker_mode': 'all_separate_cue_points',
-            'result-template': 'web',
-            'time': int(round(time.time() * 1000.0)),
-            'timestamp': datetime.datetime.utcnow().isoformat('T') + 'Z'
-        }
-        data = self.get('tune/now-playing-live', params)
+        data = self._fetch_now_playing(guid, channel_id, max_attempts)
         if not data:
             return None
-
-
-        # get status
-        try:
-            status = data['ModuleListResponse']['status']
-            message = data['ModuleListResponse']['messages'][0]['message']
-            message_code = data['ModuleListResponse']['messages'][0]['code']
-        except (KeyError, IndexError):
-            self.log('Error parsing json response for playlist')
-            return None
-
-        # login if session expired
-        if message_code == 201 or message_code == 208:
-            if max_attempts > 0:
-                self.log('Session expired, logging in and authenticating')
-                if self.authenticate():
-                    self.log('Successfully authenticated')
-                    return self.get_playlist_url(guid, channel_id, use_cache, max_attempts - 1)
-                else:
-                    self.log('Failed to authenticate')
-                    return None
-            else:
-                self.log('Reached max attempts for playlist')
-                return None
-        elif message_code != 100:
-            self.log('Received error {} {}'.format(message_code, message))
-            return None
-
-        # get m3u8 url
-        try:
-            playlists = data['ModuleListResponse']['moduleList']['modules'][0]['moduleResponse']['liveChannelData']['hlsAudioInfos']
-
-        except (KeyError, IndexError):
-            self.log('Error parsing json response for playlist')
-            return None
-        for playlist_info in playlists:
-            if playlist_info['size'] == 'LARGE':
-                playlist_url = playlist_info['url'].replace('%Live_Primary_HLS%', self.LIVE_PRIMARY_HLS)
-                self.playlists[channel_id] = self.get_playlist_variant_url(playlist_url)
-                return self.playlists[channel_id]
-
-        return None
+        self.get_song_info(guid, channel_id, data=data)
+        return self.playlists[channel_id]
 
     def get_playlist_variant_url(self, url):
-        params = {
-            'token': self.get_sxmak_token(),
-            'consumer': 'k2',
-            'gupId': self.get_gup_id(),
-        }
+        params = self.get_token_params()
         res = self.session.get(url, params=params)
 
         if res.status_code != 200:
             self.log('Received status code {} on playlist variant retrieval'.format(res.status_code))
             return None
         
-        for x in res.text.split('\n'):
-            if x.rstrip().endswith('.m3u8'):
-                # first variant should be 256k one
-                return '{}/{}'.format(url.rsplit('/', 1)[0], x.rstrip())
-        
+        # first variant should be 256k one, and it is near the top of the playlist
+        match = _VARIANT_RE.search(res.content[:4096].decode('utf-8', 'ignore')) or _VARIANT_RE.search(res.text)
+        if match:
+            return '{}/{}'.format(url.rsplit('/', 1)[0], match.group(1))
+
         return None
 
     def get_playlist(self, name, use_cache=True):
+        # players re-request the manifest every target duration, so serve a recent copy
+        if use_cache:
+            expires, playlist = self._manifest_cache.get(name, (0, None))
+            if time.time() < expires:
+                return playlist
+
         guid, channel_id = self.get_channel(name)
         if not guid or not channel_id:
             self.log('No channel for {}'.format(name))
@@ -411,15 +483,14 @@ class SiriusXM:
         # inefficient hack to get title
 
         url = self.get_playlist_url(guid, channel_id, use_cache)
-        params = {
-            'token': self.get_sxmak_token(),
-            'consumer': 'k2',
-            'gupId': self.get_gup_id(),
-        }
+        params = self.get_token_params()
         res = self.session.get(url, params=params)
 
         if res.status_code == 403:
             self.log('Received status code 403 on playlist, renewing session')
+            self._clear_token_cache()
+            with self._playlist_lock:
+                self._manifest_cache.pop(name, None)
             return self.get_playlist(name, False)
 
         if res.status_code != 200:
@@ -429,34 +500,77 @@ class SiriusXM:
         # add base path to segments
         base_url = url.rsplit('/', 1)[0]
         base_path = base_url[8:].split('/', 1)[1]
-        lines = res.text.split('\n')
-        for x in range(len(lines)):
-            if lines[x].rstrip().endswith('.aac'):
-                lines[x] = '{}/{}'.format(base_path, lines[x])
-        return '\n'.join(lines)
+        segments = []
+        def add_base_path(match):
+            segments.append('{}/{}'.format(base_path, match.group(1)))
+            return '{}/{}'.format(base_path, match.group(0))
+        playlist = _SEGMENT_RE.sub(add_base_path, res.text)
+
+        # players start near the live edge, so warm the cache with the newest segments
+        self.prefetch_segments(segments[-self.PREFETCH_SEGMENTS:])
+
+        match = _TARGET_DURATION_RE.search(playlist)
+        ttl = int(match.group(1)) if match else self.MANIFEST_TTL
+        with self._playlist_lock:
+            self._manifest_cache[name] = (time.time() + ttl, playlist)
+        return playlist
+
+    def prefetch_segments(self, paths):
+        with self._segment_lock:
+            for path in paths:
+                if path not in self._segment_cache and path not in self._prefetching:
+                    self._prefetching[path] = _PREFETCH_POOL.submit(self._prefetch_segment, path)
+
+    def _prefetch_segment(self, path):
+        try:
+            return self._fetch_segment(path)
+        except requests.RequestException as e:
+            self.log('Error prefetching segment {}: {}'.format(path, e))
+            return None
+        finally:
+            with self._segment_lock:
+                self._prefetching.pop(path, None)
 
     def get_segment(self, path, max_attempts=5):
+        with self._segment_lock:
+            data = self._segment_cache.get(path)
+            if data is not None:
+                self._segment_cache.move_to_end(path)
+                return data
+            prefetch = self._prefetching.get(path)
+
+        # the player usually asks for a new segment while it is still being prefetched,
+        # so wait for that download rather than fetching the segment a second time
+        if prefetch is not None:
+            data = prefetch.result()
+            if data is not None:
+                return data
+
+        return self._fetch_segment(path, max_attempts)
+
+    def _fetch_segment(self, path, max_attempts=5):
         url = '{}/{}'.format(self.LIVE_PRIMARY_HLS, path)
-        params = {
-            'token': self.get_sxmak_token(),
-            'consumer': 'k2',
-            'gupId': self.get_gup_id(),
-        }
-        res = self.session.get(url, params=params)
+        for attempt in range(max_attempts + 1):
+            res = self.session.get(url, params=self.get_token_params())
+            if res.status_code != 403:
+                break
 
-        if res.status_code == 403:
-            if max_attempts > 0:
-                self.log('Received status code 403 on segment, renewing session')
-                self.get_playlist(path.split('/', 2)[1], False)
-                return self.get_segment(path, max_attempts - 1)
-            else:
+            self._clear_token_cache()
+            if attempt == max_attempts:
                 self.log('Received status code 403 on segment, max attempts exceeded')
                 return None
+            self.log('Received status code 403 on segment, renewing session')
+            self.get_playlist(path.split('/', 2)[1], False)
 
         if res.status_code != 200:
             self.log('Received status code {} on segment'.format(res.status_code))
             return None
 
+        with self._segment_lock:
+            self._segment_cache[path] = res.content
+            self._segment_cache.move_to_end(path)
+            while len(self._segment_cache) > self.SEGMENT_CACHE_SIZE:
+                self._segment_cache.popitem(last=False)
         return res.content
     
     def get_channels(self):
@@ -482,19 +596,33 @@ class SiriusXM:
                 return (None, None)
 
             try:
-                self.channels = data['ModuleListResponse']['moduleList']['modules'][0]['moduleResponse']['contentData']['channelListing']['channels']
+                channels = data['ModuleListResponse']['moduleList']['modules'][0]['moduleResponse']['contentData']['channelListing']['channels']
             except (KeyError, IndexError):
                 self.log('Error parsing json response for channels')
                 return []
+
+            # index channels by lowercased name, id and number for get_channel; the index
+            # is published before self.channels so other threads never see it half built
+            channel_index = {}
+            for x in channels:
+                for key in (x.get('name', ''), x.get('channelId', ''), str(x.get('siriusChannelNumber', ''))):
+                    if key:
+                        channel_index.setdefault(key.lower(), (x['channelGuid'], x['channelId']))
+            self._channel_index = channel_index
+            self.channels = channels
         return self.channels
 
     
     def get_channel(self, name):
-        name = name.lower()
-        for x in self.get_channels():
-            if x.get('name', '').lower() == name or x.get('channelId', '').lower() == name or x.get('siriusChannelNumber') == name:
-                return (x['channelGuid'], x['channelId'])
-        return (None, None)
+        self.get_channels()
+        return self._channel_index.get(name.lower(), (None, None))
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server that handles each request in its own thread, so a slow upstream
+    fetch for one request does not stall the others.
+    """
+    daemon_threads = True
 
 def make_sirius_handler(sxm):
     """
@@ -510,14 +638,9 @@ def make_sirius_handler(sxm):
         """
         Handles HTTP requests for the proxy server.
 
-        Attributes:
-            HLS_AES_KEY (bytes): AES decryption key for HLS segments.
-
         Methods:
             do_GET(): Handles GET requests for playlists and segments.
         """
-        HLS_AES_KEY = base64.b64decode('0Nsco7MAgxowGvkUT8aYag==')
-
         def do_GET(self):
             if self.path.endswith('.m3u8'):
                 data = sxm.get_playlist(self.path.rsplit('/', 1)[1][:-5])
@@ -545,7 +668,7 @@ def make_sirius_handler(sxm):
                 self.send_response(200)
                 self.send_header('Content-Type', 'text/plain')
                 self.end_headers()
-                self.wfile.write(self.HLS_AES_KEY)
+                self.wfile.write(HLS_AES_KEY)
             else:
                 self.send_response(500)
                 self.end_headers()
@@ -562,19 +685,20 @@ if __name__ == '__main__':
     sxm = SiriusXM(secrets['username'], secrets['password'])
     #sxm = SiriusXM(args['username'], args['password'])
     if args['list']:
-        channels = list(sorted(sxm.get_channels(), key=lambda x: (not x.get('isFavorite', False), int(x.get('siriusChannelNumber', 9999)))))
-        
-        l1 = max(len(x.get('channelId', '')) for x in channels)
-        l2 = max(len(str(x.get('siriusChannelNumber', 0))) for x in channels)
-        l3 = max(len(x.get('name', '')) for x in channels)
+        # (id, number, name, sort keys...) computed once per channel
+        rows = [(x.get('channelId', '') or '',
+                 str(x.get('siriusChannelNumber') or '??'),
+                 x.get('name', '') or '??',
+                 not x.get('isFavorite', False),
+                 int(x.get('siriusChannelNumber') or 9999)) for x in sxm.get_channels()]
+        rows.sort(key=itemgetter(3, 4))
+
+        l1, l2, l3 = map(max, zip(*((len(cid), len(cnum), len(cname)) for cid, cnum, cname, _, _ in rows)))
         print('{} | {} | {}'.format('ID'.ljust(l1), 'Num'.ljust(l2), 'Name'.ljust(l3)))
-        for channel in channels:
-            cid = channel.get('channelId', '').ljust(l1)[:l1]
-            cnum = str(channel.get('siriusChannelNumber', '??')).ljust(l2)[:l2]
-            cname = channel.get('name', '??').ljust(l3)[:l3]
-            print('{} | {} | {}'.format(cid, cnum, cname))
+        for cid, cnum, cname, _, _ in rows:
+            print('{} | {} | {}'.format(cid.ljust(l1), cnum.ljust(l2), cname.ljust(l3)))
     else:
-        httpd = HTTPServer(('', args['port']), make_sirius_handler(sxm))
+        httpd = ThreadingHTTPServer(('', args['port']), make_sirius_handler(sxm))
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
@@ -0,0 +1,52 @@
+import sys
+import threading
+import types
+import unittest
+
+# sxm reads credentials and connects to Adafruit IO at import, so stand in for both
+sys.modules.setdefault('my_secrets', types.SimpleNamespace(secrets={
+    'username': 'user', 'password': 'password', 'aio_user': 'aio', 'aio_key': 'key'}))
+sys.modules.setdefault('Adafruit_IO', types.SimpleNamespace(
+    Client=lambda *args: types.SimpleNamespace(feeds=lambda name: types.SimpleNamespace(key=name),
+                                               send_data=lambda key, value: None),
+    RequestError=Exception))
+
+import sxm
+
+
+class FakeResponse:
+    status_code = 200
+    content = b'segment'
+
+
+class SegmentPrefetchTest(unittest.TestCase):
+    def test_request_during_prefetch_fetches_once(self):
+        s = sxm.SiriusXM('user', 'password')
+        s._token_params = {'token': 't', 'consumer': 'k2', 'gupId': 'g'}
+        started = threading.Event()
+        release = threading.Event()
+        fetches = []
+
+        def get(url, params=None):
+            fetches.append(url)
+            started.set()
+            release.wait(5)
+            return FakeResponse()
+        s.session.get = get
+
+        s.prefetch_segments(['a/b.aac'])
+        self.assertTrue(started.wait(5))
+
+        result = []
+        request = threading.Thread(target=lambda: result.append(s.get_segment('a/b.aac')))
+        request.start()
+        request.join(0.05) # let the request find the in-flight prefetch
+        release.set()
+        request.join(5)
+
+        self.assertEqual(result, [b'segment'])
+        self.assertEqual(len(fetches), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()